@@ -0,0 +1,8 @@
+def __getattr__(name):
+    # Load the engine on first use, so that running a module within the package
+    # (e.g. python -m balloonalert.benchmark) does not import it before execution.
+    if name == "BalloonAlert":
+        from .engine import BalloonAlert
+        return BalloonAlert
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+#
+#   BalloonAlert - Micro-benchmarks
+#
+#   Times the functions run for every telemetry packet / prediction, using offline fixtures,
+#   and compares the results against a stored baseline. Timings are stored relative to a fixed
+#   calibration loop timed in the same run, so the baseline does not depend on the machine speed.
+#
+#   Usage:
+#       python -m balloonalert.benchmark            Compare against the baseline, exit 1 if any are slower.
+#       python -m balloonalert.benchmark --save     Save the results as the new baseline.
+#
+#   The allowed slowdown for each benchmark is set by its 'tolerance' in the baseline file.
+#
+import argparse
+import datetime
+import json
+import logging
+import math
+import os
+import statistics
+import sys
+import timeit
+from unittest import mock
+
+from .config import read_config
+from .engine import BalloonAlert
+from .payload_filters import is_pico_balloon
+from .position_filters import create_geofence, create_radius_filter, position_info, position_info_batch
+from .tawhiri import TawhiriGovernor, parse_tawhiri_data
+from . import tawhiri
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_BASELINE = os.path.join(REPO_DIR, "benchmark_baseline.json")
+GEOFENCE_FILE = os.path.join(REPO_DIR, "example_geofence.txt")
+CONFIG_FILE = os.path.join(REPO_DIR, "alert.cfg.example")
+
+# Allowed slowdown relative to the baseline, for benchmarks without a tolerance in the baseline file.
+DEFAULT_TOLERANCE = 0.25
+
+# Telemetry fixtures, as received from SondeHub-Amateur
+TELEMETRY_PICO = {'software_name': 'SondeHub APRS-IS Gateway', 'software_version': '2023.04.16', 'uploader_callsign': 'LU7AA', 'path': 'TCPIP*,qAR,LU7AA', 'time_received': '2023-05-01T01:27:08.941191Z', 'payload_callsign': 'VE3KCL-32', 'datetime': '2023-05-01T01:27:08.000000Z', 'lat': 51.39, 'lon': -170.28816666666665, 'alt': 12640.056, 'comment': 'AO41UJ 41C 3.6V To:49 Up:0m/s V:66Km/h Sun:47 WSPR PicoBalloon http://lu7aa.org/wsprx.asp?other=ve3kcl&launch=20221021142000&SSID=32&banda=20m&balloonid=04&timeslot=8&tracker=qrplabs', 'raw': 'VE3KCL-32>APRS,TCPIP*,qAR,LU7AA:/012708h5123.40N/17017.29WO000/000/A=041470 AO41UJ 41C 3.6V To:49 Up:0m/s V:66Km/h Sun:47 WSPR PicoBalloon http://lu7aa.org/wsprx.asp?other=ve3kcl&launch=20221021142000&SSID=32&banda=20m&balloonid=04&timeslot=8&tracker=qrplabs', 'aprs_tocall': 'APRS', 'modulation': 'APRS'}
+TELEMETRY_OTHER = {'software_name': 'SondeHub APRS-IS Gateway', 'software_version': '2023.04.16', 'uploader_callsign': 'DB0ERF-10', 'path': 'WIDE1-1,WIDE2-1,qAR,DB0ERF-10', 'time_received': '2023-05-01T01:27:00.745299Z', 'payload_callsign': 'DC2EH-6', 'datetime': '2023-05-01T01:27:00.745276Z', 'lat': 51.58833333333333, 'lon': 10.350666666666667, 'alt': 662.94, 'comment': 'www.ballon.org', 'raw': 'DC2EH-6>APT3A2,WIDE1-1,WIDE2-1,qAR,DB0ERF-10:!5135.30N/01021.04EO310/018/A=002175/www.ballon.org', 'aprs_tocall': 'APT3A2', 'modulation': 'APRS'}
+
+
+def float_response(hours=120, step=60):
+    """
+    Create a Tawhiri float prediction response, in the format returned by the API.
+
+    The trajectory is a deterministic eastward drift around the northern hemisphere (as a floater
+    typically follows), with one point every step seconds for the given number of hours.
+    """
+
+    _start = datetime.datetime(2023, 5, 1, 1, 27, 8)
+    _points = int(hours * 3600 / step)
+
+    _ascent = []
+    _float = []
+
+    for _i in range(_points):
+        _t = _i * step
+        _point = {
+            "datetime": (_start + datetime.timedelta(seconds=_t)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "latitude": 51.39 + 3.0 * math.sin(_t / 20000.0),
+            "longitude": (189.71 + _t * 0.0004) % 360.0,
+            "altitude": 12640.056 + 50.0 * math.sin(_t / 3000.0),
+        }
+
+        if _i < 2:
+            _ascent.append(_point)
+        else:
+            _float.append(_point)
+
+    return {
+        "metadata": {"complete_datetime": "2023-05-01T01:27:10.000000Z", "start_datetime": "2023-05-01T01:27:09.000000Z"},
+        "prediction": [
+            {"stage": "ascent", "trajectory": _ascent},
+            {"stage": "float", "trajectory": _float},
+        ],
+        "request": {
+            "dataset": "2023-04-30T18:00:00Z",
+            "float_altitude": 12641.056,
+            "launch_altitude": 12640.056,
+            "launch_datetime": "2023-05-01T01:27:08Z",
+            "launch_latitude": 51.39,
+            "launch_longitude": 189.71183333333335,
+            "profile": "float_profile",
+            "stop_datetime": "2023-05-06T01:27:08Z",
+            "version": 1,
+        },
+        "warnings": {},
+    }
+
+
+def position_fixtures(count=1000):
+    """ Return a deterministic list of (lat, lon) positions, spread around the geofence / radius. """
+
+    return [
+        (-34.0 + 30.0 * math.sin(_i * 0.37), 138.0 + 45.0 * math.cos(_i * 0.53))
+        for _i in range(count)
+    ]
+
+
+def run_benchmarks(number=None, repeat=15):
+    """
+    Run the benchmarks, returning a dictionary of {name: {'relative': r, 'seconds': s}}, where s is the
+    median time per call, and r is the median time per call relative to the calibration loop.
+    If number is not supplied, each benchmark is run for at least ~0.05 seconds per repeat.
+    """
+
+    _positions = position_fixtures()
+    # parse_tawhiri_data modifies the response, so decode a fresh copy each time (as the API client does).
+    _response = json.dumps(float_response())
+    _path = parse_tawhiri_data(json.loads(_response))['path']
+    _path_positions = [(_p[1], _p[2], _p[3]) for _p in _path]
+
+    _geofence = create_geofence(GEOFENCE_FILE)
+    _geofence_grid = create_geofence(GEOFENCE_FILE, grid_cell_size=1.0)
+    _radius = create_radius_filter(-34.0, 138.0, 1000.0)
+    _radius_grid = create_radius_filter(-34.0, 138.0, 1000.0, grid_cell_size=1.0)
+
+    def check_positions(position_filter):
+        for _lat, _lon in _positions:
+            position_filter(_lat, _lon)
+
+    # process_telemetry, with the Tawhiri API stubbed out, running a prediction for every packet.
+    _config = read_config(CONFIG_FILE)
+    _config['email_enabled'] = False
+    _alert = BalloonAlert(_config, governor=TawhiriGovernor(rate=1e9, burst=1e9))
+
+    _http_response = mock.Mock(status_code=200)
+    _http_response.json.side_effect = lambda: json.loads(_response)
+    _session = mock.Mock()
+    _session.get.return_value = _http_response
+
+    def process_telemetry():
+        _alert.telemetry_store.clear()
+        _alert.process_telemetry(TELEMETRY_PICO)
+
+    # (name, function, calls per run)
+    _benchmarks = [
+        ("geofence_within_bounds", lambda: check_positions(_geofence), len(_positions)),
+        ("geofence_within_bounds_grid", lambda: check_positions(_geofence_grid), len(_positions)),
+        ("radius_filter", lambda: check_positions(_radius), len(_positions)),
+        ("radius_filter_grid", lambda: check_positions(_radius_grid), len(_positions)),
+        ("position_info", lambda: position_info((-34.0, 138.0, 0.0), (51.39, -170.29, 12640.0)), 1),
+        ("position_info_batch", lambda: position_info_batch((-34.0, 138.0, 0.0), _path_positions), len(_path)),
+        ("is_pico_balloon", lambda: (is_pico_balloon(TELEMETRY_PICO), is_pico_balloon(TELEMETRY_OTHER)), 2),
+        ("parse_tawhiri_data", lambda: parse_tawhiri_data(json.loads(_response)), 1),
+        ("process_telemetry", process_telemetry, 1),
+    ]
+
+    _results = {}
+
+    # Silence the per-packet log messages while timing.
+    _level = logging.getLogger().level
+    logging.getLogger().setLevel(logging.ERROR)
+
+    try:
+        with mock.patch.object(tawhiri, "get_tawhiri_session", return_value=_session):
+            _calibration_timer = timeit.Timer(calibration)
+            _calibration_number = timer_number(_calibration_timer)
+
+            for (_name, _func, _calls) in _benchmarks:
+                _timer = timeit.Timer(_func)
+                _number = number if number is not None else timer_number(_timer)
+
+                # Time the calibration loop immediately before each repeat of the benchmark, so that
+                # both are measured under the same machine conditions, and use the median ratio.
+                _ratios = []
+                _times = []
+                for _i in range(repeat):
+                    _calibration = _calibration_timer.timeit(_calibration_number) / _calibration_number
+                    _time = _timer.timeit(_number) / _number / _calls
+                    _ratios.append(_time / _calibration)
+                    _times.append(_time)
+
+                _results[_name] = {
+                    "relative": statistics.median(_ratios),
+                    "seconds": statistics.median(_times),
+                }
+    finally:
+        logging.getLogger().setLevel(_level)
+
+    return _results
+
+
+def calibration():
+    """
+    Fixed workload used to normalise the benchmark timings, so results are comparable between
+    runs (and machines) regardless of the overall machine speed or load.
+    """
+
+    _total = 0.0
+    _values = {}
+
+    for _i in range(2000):
+        _total += math.sin(_i * 0.001) * math.cos(_i * 0.002)
+        _values[_i % 64] = _total
+
+    return _total
+
+
+def timer_number(timer, target=0.05):
+    """ Return the number of calls of a timeit Timer needed to take at least target seconds. """
+
+    _number = 1
+    while True:
+        if timer.timeit(_number) >= target:
+            return _number
+        _number *= 2
+
+
+def compare_results(results, baseline, tolerance=None):
+    """
+    Compare benchmark results against a baseline.
+
+    Each benchmark is allowed to be slower than the baseline by its tolerance from the baseline file
+    (or DEFAULT_TOLERANCE), unless tolerance is supplied.
+
+    Returns a list of the names of benchmarks which are slower than the baseline by more than the tolerance.
+    """
+
+    _slower = []
+
+    for _name, _result in results.items():
+        if _name not in baseline:
+            print(f"{_name:32s} {_result['relative']:10.4f} ({_result['seconds']*1e6:12.3f} us)    (no baseline)")
+            continue
+
+        _tolerance = tolerance if tolerance is not None else baseline[_name].get("tolerance", DEFAULT_TOLERANCE)
+
+        _ratio = _result['relative'] / baseline[_name]['relative']
+        _flag = ""
+        if _ratio > (1 + _tolerance):
+            _slower.append(_name)
+            _flag = "  SLOWER"
+
+        print(f"{_name:32s} {_result['relative']:10.4f} ({_result['seconds']*1e6:12.3f} us)    baseline {baseline[_name]['relative']:10.4f}    x{_ratio:.2f} (limit x{1 + _tolerance:.2f}){_flag}")
+
+    return _slower
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="BalloonAlert micro-benchmarks")
+    parser.add_argument(
+        "--baseline", type=str, default=DEFAULT_BASELINE, help="Baseline results file."
+    )
+    parser.add_argument(
+        "--save", action="store_true", help="Save the results as the new baseline."
+    )
+    parser.add_argument(
+        "--tolerance", type=float, default=None, help="Allowed slowdown relative to the baseline, overriding the per-benchmark tolerances in the baseline file (e.g. 0.25 = 25%%)."
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s %(levelname)s: %(message)s", level=logging.WARNING)
+
+    results = run_benchmarks()
+
+    if args.save:
+        # Retain any per-benchmark tolerances from the existing baseline.
+        _tolerances = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline, 'r') as _f:
+                _tolerances = {_name: _entry.get("tolerance", DEFAULT_TOLERANCE) for _name, _entry in json.load(_f).items()}
+
+        baseline = {
+            _name: {
+                "relative": _result["relative"],
+                "tolerance": args.tolerance if args.tolerance is not None else _tolerances.get(_name, DEFAULT_TOLERANCE),
+            }
+            for _name, _result in results.items()
+        }
+
+        with open(args.baseline, 'w') as _f:
+            json.dump(baseline, _f, indent=4, sort_keys=True)
+            _f.write("\n")
+
+        for _name, _result in results.items():
+            print(f"{_name:32s} {_result['relative']:10.4f} ({_result['seconds']*1e6:12.3f} us)")
+        print(f"Saved baseline to {args.baseline}")
+        sys.exit(0)
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline file {args.baseline} - run with --save to create one.")
+        sys.exit(1)
+
+    with open(args.baseline, 'r') as _f:
+        baseline = json.load(_f)
+
+    slower = compare_results(results, baseline, args.tolerance)
+
+    if slower:
+        print(f"Benchmarks slower than baseline: {', '.join(slower)}")
+        sys.exit(1)
+
+    print("All benchmarks within tolerance of baseline.")
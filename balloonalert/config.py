@@ -20,12 +20,37 @@ def parse_config_file(filename):
     alert_config['radius_longitude'] = config.getfloat("filtering", "radius_longitude")
     # Geofence Filtering
     alert_config['geofence_file'] = config.get("filtering", "geofence_file")
+    # Telemetry queue coalescing
+    alert_config['coalesce_telemetry'] = config.getboolean("filtering", "coalesce_telemetry", fallback=True)
+    alert_config['coalesce_history'] = config.getboolean("filtering", "coalesce_history", fallback=True)
+    alert_config['history_length'] = config.getint("filtering", "history_length", fallback=100)
+    # Grid lookup
+    alert_config['grid_lookup'] = config.getboolean("filtering", "grid_lookup", fallback=False)
+    alert_config['grid_cell_size'] = config.getfloat("filtering", "grid_cell_size", fallback=1.0)
+    alert_config['grid_depth'] = config.getint("filtering", "grid_depth", fallback=6)
+    alert_config['grid_cache_file'] = config.get("filtering", "grid_cache_file", fallback="")
 
     # Prediction Settings
     alert_config['predictions_enabled'] = config.getboolean("predictions", "predictions_enabled")
     alert_config['prediction_min_altitude'] = config.getint("predictions", "prediction_min_altitude")
     alert_config['float_duration'] = config.getint("predictions", "float_duration")
     alert_config['prediction_rerun_time'] = config.getint("predictions", "prediction_rerun_time")
+    # Ensemble predictions
+    alert_config['ensemble_enabled'] = config.getboolean("predictions", "ensemble_enabled", fallback=False)
+    alert_config['ensemble_altitude_offsets'] = [float(_x) for _x in config.get("predictions", "ensemble_altitude_offsets", fallback="-1000,0,1000").split(",")]
+    alert_config['ensemble_time_offsets'] = [float(_x) for _x in config.get("predictions", "ensemble_time_offsets", fallback="0,1").split(",")]
+    alert_config['ensemble_datasets'] = config.getint("predictions", "ensemble_datasets", fallback=1)
+    alert_config['ensemble_threshold'] = config.getfloat("predictions", "ensemble_threshold", fallback=0.5)
+    alert_config['ensemble_min_success'] = config.getfloat("predictions", "ensemble_min_success", fallback=0.5)
+    alert_config['ensemble_workers'] = config.getint("predictions", "ensemble_workers", fallback=8)
+    # Tawhiri request governor
+    alert_config['tawhiri_rate_limit'] = config.getfloat("predictions", "tawhiri_rate_limit", fallback=0.5)
+    alert_config['tawhiri_burst'] = config.getint("predictions", "tawhiri_burst", fallback=10)
+    alert_config['tawhiri_backoff_base'] = config.getfloat("predictions", "tawhiri_backoff_base", fallback=60.0)
+    alert_config['tawhiri_backoff_max'] = config.getfloat("predictions", "tawhiri_backoff_max", fallback=3600.0)
+    alert_config['tawhiri_failure_threshold'] = config.getint("predictions", "tawhiri_failure_threshold", fallback=5)
+    alert_config['tawhiri_cooldown'] = config.getfloat("predictions", "tawhiri_cooldown", fallback=600.0)
+    alert_config['status_log_interval'] = config.getfloat("predictions", "status_log_interval", fallback=3600.0)
     
     # Email settings
     alert_config["email_enabled"] = config.getboolean(
@@ -54,6 +79,14 @@ def parse_config_file(filename):
         )
         return None
 
+    # Each ensemble is requested as a single batch, so must fit within the request burst limit.
+    _ensemble_members = len(alert_config['ensemble_altitude_offsets']) * len(alert_config['ensemble_time_offsets']) * alert_config['ensemble_datasets']
+    if alert_config['ensemble_enabled'] and _ensemble_members > alert_config['tawhiri_burst']:
+        logging.error(
+            f"Config - Ensemble of {_ensemble_members} predictions exceeds tawhiri_burst ({alert_config['tawhiri_burst']}). Reduce the ensemble size or increase tawhiri_burst."
+        )
+        return None
+
     
     return alert_config
 
@@ -1,9 +1,6 @@
 import datetime
 import logging
 import time
-import smtplib
-from email.mime.text import MIMEText
-from email.utils import formatdate
 from .config import read_config
 
 def send_email_notification(config, subject, message):
@@ -11,6 +8,10 @@ def send_email_notification(config, subject, message):
     Attempt to send an email alert.
     """
 
+    import smtplib
+    from email.mime.text import MIMEText
+    from email.utils import formatdate
+
     try:
         msg = "BalloonAlert Email Notification Message:\n"
         msg += "Timestamp: %s\n" % datetime.datetime.now().isoformat()
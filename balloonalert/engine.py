@@ -0,0 +1,584 @@
+import logging
+import time
+from collections import deque
+from queue import Queue, Empty
+from threading import Lock, Thread
+from .config import parse_config_file
+from .tawhiri import TawhiriGovernor, get_tawhiri_float_prediction, get_tawhiri_float_ensemble
+from .position_filters import create_position_filter, position_filter_signature
+from .payload_filters import is_pico_balloon
+from .email_notification import send_email_notification
+
+
+def governor_limits(config):
+    """ Extract the Tawhiri request governor limits from a configuration dictionary. """
+
+    return {
+        'rate': config['tawhiri_rate_limit'],
+        'burst': config['tawhiri_burst'],
+        'backoff_base': config['tawhiri_backoff_base'],
+        'backoff_max': config['tawhiri_backoff_max'],
+        'failure_threshold': config['tawhiri_failure_threshold'],
+        'cooldown': config['tawhiri_cooldown'],
+    }
+
+
+class BalloonAlert(object):
+    """
+    BalloonAlert engine.
+
+    Telemetry packets (as received from SondeHub-Amateur) are supplied via feed(), either by
+    a SondeHub-Amateur stream opened by start(), or by the caller, and are processed in a
+    separate thread. Payloads within (or predicted to be within) the position filter
+    result in an alert.
+
+    Multiple instances can be run within one process.
+
+    The configuration can be reloaded while running using reload(), which retains the
+    telemetry store and SondeHub-Amateur connection.
+    """
+
+    def __init__(self, config, on_alert=None, on_prediction=None, governor=None, config_file=None):
+        """
+        config: Configuration dictionary, as returned by read_config.
+        on_alert: Optional callback, called with (callsign, alert_type, timestamp, telemetry, details)
+            when an alert is raised. alert_type is either "now" or "prediction". details is the
+            ensemble dictionary returned by run_ensemble_prediction (including the probability and
+            number of successful predictions) for ensemble prediction alerts, and None otherwise.
+        on_prediction: Optional callback, called with (callsign, prediction) after each
+            successful prediction run. If ensemble predictions are enabled, prediction is
+            the ensemble dictionary returned by run_ensemble_prediction.
+        governor: Optional TawhiriGovernor to use for prediction requests. If not provided,
+            one is created using the limits in the configuration (and updated on reload).
+        config_file: Configuration file to use when reload() is called without a filename.
+        """
+
+        self.config = config
+        self.config_file = config_file
+        self.on_alert = on_alert
+        self.on_prediction = on_prediction
+
+        # Position filtering function pointer
+        self.position_filter = create_position_filter(config)
+        self.position_filter_signature = position_filter_signature(config)
+
+        # Tawhiri request governor
+        self.own_governor = governor is None
+        if governor is None:
+            governor = TawhiriGovernor(**governor_limits(config))
+        self.tawhiri_governor = governor
+
+        # Held while processing a packet, and while swapping in a reloaded configuration.
+        self.update_lock = Lock()
+        # Serialises configuration reloads.
+        self.reload_lock = Lock()
+
+        # Queue of telemetry packets to process
+        self.telemetry_queue = Queue()
+
+        # Store of telemetry data, keyed by callsign
+        self.telemetry_store = {}
+
+        # Number of packets skipped by coalescing the telemetry queue
+        self.coalesced_packets = 0
+
+        self.telemetry_processing_running = False
+        self.telemetry_thread = None
+        self.stream = None
+
+    def start(self, stream=True):
+        """
+        Start the telemetry processing thread and, if stream is True, the SondeHub-Amateur connection.
+        """
+
+        if self.telemetry_processing_running:
+            return
+
+        self.telemetry_processing_running = True
+        self.telemetry_thread = Thread(target=self.handle_telemetry_queue, daemon=True)
+        self.telemetry_thread.start()
+
+        if stream:
+            import sondehub
+
+            logging.info("Starting SondeHub-Amateur Connection.")
+            self.stream = sondehub.Stream(on_message=self.feed, prefix="amateur")
+
+    def stop(self):
+        """
+        Close the SondeHub-Amateur connection (if open), and stop the telemetry processing thread.
+        """
+
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+        self.telemetry_processing_running = False
+
+        if self.telemetry_thread is not None:
+            self.telemetry_thread.join()
+            self.telemetry_thread = None
+
+    def reload(self, filename=None):
+        """
+        Reload the configuration file in a background thread.
+
+        Only the parts of the engine affected by changed settings are re-created, and the new
+        configuration is swapped in between telemetry packets. If the new configuration cannot be
+        read, the existing configuration is retained.
+
+        Returns the reload thread.
+        """
+
+        if filename is None:
+            filename = self.config_file
+
+        _thread = Thread(target=self.reload_config, args=(filename,), daemon=True)
+        _thread.start()
+
+        return _thread
+
+    def reload_config(self, filename):
+        """
+        Reload the configuration file. Refer reload().
+        """
+
+        with self.reload_lock:
+            logging.info(f"Reloading configuration from {filename}")
+
+            try:
+                _config = parse_config_file(filename)
+            except Exception as e:
+                logging.error(f"Could not parse {filename}, keeping existing configuration: {str(e)}")
+                return
+
+            if _config is None:
+                logging.error(f"Invalid configuration in {filename}, keeping existing configuration.")
+                return
+
+            # Re-create the position filter only if its settings have changed.
+            _signature = position_filter_signature(_config)
+
+            if _signature != self.position_filter_signature:
+                try:
+                    _position_filter = create_position_filter(_config)
+                except Exception as e:
+                    logging.error(f"Could not create position filter, keeping existing configuration: {str(e)}")
+                    return
+            else:
+                _position_filter = self.position_filter
+
+            # Swap in the new configuration between telemetry packets.
+            with self.update_lock:
+                self.config = _config
+                self.position_filter = _position_filter
+                self.position_filter_signature = _signature
+
+                if self.own_governor:
+                    self.tawhiri_governor.set_limits(**governor_limits(_config))
+
+            logging.info(f"Reloaded configuration from {filename}")
+
+    def status(self):
+        """
+        Return the current engine state as a dictionary, containing:
+         - tawhiri: The Tawhiri request governor state (refer TawhiriGovernor.get_status). Its 'degraded'
+           field is True while predictions are suspended by the circuit breaker.
+         - payloads: The number of payloads in the telemetry store.
+         - queue_size: The number of telemetry packets waiting to be processed.
+         - coalesced_packets: The number of packets skipped by coalescing the telemetry queue.
+        """
+
+        return {
+            'tawhiri': self.tawhiri_governor.get_status(),
+            'payloads': len(self.telemetry_store),
+            'queue_size': self.telemetry_queue.qsize(),
+            'coalesced_packets': self.coalesced_packets,
+        }
+
+    def log_status(self):
+        """
+        Log the current engine state, as a warning if predictions are degraded.
+        """
+
+        _status = self.status()
+        _tawhiri = _status['tawhiri']
+
+        _msg = (
+            f"Status - {_status['payloads']} payloads, {_status['queue_size']} queued packets, "
+            f"{_status['coalesced_packets']} coalesced packets. "
+            f"Tawhiri circuit breaker {_tawhiri['circuit_state']}, {len(_tawhiri['backed_off'])} payloads backed off, "
+            f"{_tawhiri['stats']['successes']} successful / {_tawhiri['stats']['failures']} failed predictions."
+        )
+
+        if _tawhiri['degraded']:
+            logging.warning(f"{_msg} Predictions degraded, {_tawhiri['cooldown_remaining']:.0f} seconds until retry.")
+        else:
+            logging.info(_msg)
+
+    def feed(self, packet):
+        """
+        Add a telemetry packet to the processing queue.
+        """
+
+        self.telemetry_queue.put(packet)
+
+    def send_alert(self, callsign, alert_type, timestamp, telemetry, details=None):
+
+        if self.on_alert is not None:
+            try:
+                self.on_alert(callsign, alert_type, timestamp, telemetry, details)
+            except Exception as e:
+                logging.error(f"Error in alert callback - {str(e)}")
+
+        if not self.config['email_enabled']:
+            logging.info("Not sending notification email, as notifications disabled.")
+            return
+
+        _sondehub_link = f"https://amateur.sondehub.org/?sondehub=1#!mt=Mapnik&mz=4&qm=1d&q={callsign}"
+
+        if alert_type == "now":
+            subject = f"BalloonAlert - {callsign} is within position filter limits now!"
+
+            msg = f"Payload {callsign} observed within position filter limits at {timestamp}\n"
+            msg += f"SondeHub-Amateur Link: {_sondehub_link}\n"
+
+        else:
+            subject = f"BalloonAlert - {callsign} predicted to be within position filter limits at {timestamp}."
+            msg = f"Payload {callsign} predicted to be within position filter limits at {timestamp}\n"
+            msg += f"SondeHub-Amateur Link: {_sondehub_link}\n"
+            msg += f"(Use 'Float' prediction button)\n"
+
+        if details:
+            msg += f"{details['summary']}\n"
+
+        msg += "\n\n\n"
+        msg += f"Last Telemetry: {str(telemetry)}"
+
+        send_email_notification(self.config, subject, msg)
+
+    def process_telemetry(self, data, skipped=()):
+        """
+        Process a telemetry packet.
+
+        skipped is a list of older packets from the same payload which were superseded by this
+        packet while coalescing the telemetry queue (refer coalesce_telemetry).
+        """
+
+        from dateutil.parser import parse
+
+        config = self.config
+        telemetry_store = self.telemetry_store
+
+        logging.debug(f"Got telemetry: {data}")
+
+        _callsign = data['payload_callsign']
+
+        if config['picoballoon_only']:
+            if not is_pico_balloon(data):
+                logging.debug(f"Payload {_callsign} is not a picoballoon - discarding.")
+                return
+
+        # Create new entry in telemetry store
+        if _callsign not in telemetry_store:
+            telemetry_store[_callsign] = {
+                'latest_data': data,
+                'last_prediction': 0,
+                'last_email': 0,
+                'last_position': (data['lat'], data['lon'], data['alt']),
+                'last_datetime': parse(data['datetime']),
+                'last_ascent_rate': None,
+                'last_velocity': None,
+                'last_heading': None,
+                'history': deque(maxlen=config['history_length']),
+                'skipped_packets': 0,
+            }
+
+            logging.info(f"New Payload Seen: {_callsign}")
+
+        # Record positions from any older packets skipped while coalescing, and then this packet.
+        telemetry_store[_callsign]['skipped_packets'] += len(skipped)
+
+        if config['coalesce_history']:
+            for _packet in skipped:
+                try:
+                    telemetry_store[_callsign]['history'].append(
+                        (parse(_packet['datetime']), _packet['lat'], _packet['lon'], _packet['alt'])
+                    )
+                except Exception as e:
+                    logging.debug(f"Payload {_callsign} - Could not add skipped packet to history - {str(e)}")
+
+        telemetry_store[_callsign]['history'].append((parse(data['datetime']), data['lat'], data['lon'], data['alt']))
+
+        if parse(data['datetime']) != telemetry_store[_callsign]['last_datetime']:
+            # Attempt to calculate ascent rate, velocity, and heading.
+            pass
+
+        # Write the new information into the telemetry store.
+        telemetry_store[_callsign]['latest_data'] = data
+        telemetry_store[_callsign]['last_position'] = (data['lat'], data['lon'], data['alt'])
+        telemetry_store[_callsign]['last_datetime'] = parse(data['datetime'])
+
+        # Compare current positions against filters.
+        if self.position_filter(data['lat'], data['lon']):
+            # Current position is within our position filter!
+            logging.warning(f"Payload {_callsign} is within our position filter!")
+
+            if (time.time() - telemetry_store[_callsign]['last_email']) > config['email_resend_time']*3600:
+                # Send alert email
+                logging.debug(f"Payload {_callsign} - Sending alert email.")
+
+                self.send_alert(_callsign, "now", data['datetime'], data)
+
+                telemetry_store[_callsign]['last_email'] = time.time()
+            else:
+                logging.info(f"Payload {_callsign} - Too soon to send email.")
+
+        else:
+            # Can we run a prediction?
+            if (time.time() - telemetry_store[_callsign]['last_prediction']) > config['prediction_rerun_time']*3600:
+                if data['alt'] > config['prediction_min_altitude']:
+                    # Run a forward prediction.
+                    if config['ensemble_enabled']:
+                        _pred, _pred_within_filter = self.run_ensemble_prediction(_callsign, data)
+                    else:
+                        _pred, _pred_within_filter = self.run_float_prediction(_callsign, data)
+
+                    if _pred:
+                        telemetry_store[_callsign]['last_prediction_data'] = _pred
+
+                        if self.on_prediction is not None:
+                            try:
+                                self.on_prediction(_callsign, _pred)
+                            except Exception as e:
+                                logging.error(f"Error in prediction callback - {str(e)}")
+
+                        if _pred_within_filter:
+                            logging.info(f"Payload {_callsign} - Predicted to enter position filter at {_pred_within_filter}!")
+
+                            if (time.time() - telemetry_store[_callsign]['last_email']) > config['email_resend_time']*3600:
+                                # Send alert email
+                                logging.debug(f"Payload {_callsign} - Sending alert email.")
+
+                                self.send_alert(_callsign, "prediction", _pred_within_filter, data, details=_pred if 'summary' in _pred else None)
+
+                                telemetry_store[_callsign]['last_email'] = time.time()
+                            else:
+                                logging.info(f"Payload {_callsign} - Too soon to send email.")
+
+                        # Only successful predictions hold off re-runs, failed requests are retried
+                        # as allowed by the Tawhiri request governor.
+                        telemetry_store[_callsign]['last_prediction'] = time.time()
+                else:
+                    logging.info(f"Payload {_callsign} - Too low in altitude to run prediction.")
+            else:
+                logging.info(f"Payload {_callsign} - Prediction run too recently.")
+
+    def prediction_filter_entry(self, path):
+        """
+        Return the time at which a prediction path first enters the position filter, or None if it does not.
+        """
+
+        for _position in path:
+            if self.position_filter(_position[1], _position[2]):
+                # Prediction entry is within our position filter!
+                return _position[0]
+
+        return None
+
+    def run_float_prediction(self, callsign, data):
+        """
+        Run a float prediction for a payload.
+
+        Returns a tuple of (prediction, entry_time), where entry_time is the time the prediction
+        enters the position filter (or None), or (None, None) if the prediction failed.
+        """
+
+        # Avoid logging for every packet while predictions are being held off by the governor.
+        # (Circuit breaker state changes are logged by the governor.)
+        if not self.tawhiri_governor.would_allow(callsign):
+            logging.debug(f"Payload {callsign} - Float prediction deferred by Tawhiri request governor.")
+            return (None, None)
+
+        logging.info(f"Payload {callsign} - Running float prediction.")
+
+        _pred = get_tawhiri_float_prediction(
+            launch_datetime=self.telemetry_store[callsign]['last_datetime'],
+            launch_latitude=data['lat'],
+            launch_longitude=data['lon'],
+            launch_altitude=data['alt'],
+            float_time_hrs=self.config['float_duration'],
+            key=callsign,
+            governor=self.tawhiri_governor
+        )
+
+        if _pred is None:
+            return (None, None)
+
+        logging.debug(f"Payload {callsign} - Prediction run OK, {len(_pred['path'])} data points.")
+
+        return (_pred, self.prediction_filter_entry(_pred['path']))
+
+    def run_ensemble_prediction(self, callsign, data):
+        """
+        Run an ensemble of float predictions for a payload, and determine the probability of
+        the payload entering the position filter.
+
+        Returns a tuple of (ensemble, entry_time), where entry_time is the earliest time an ensemble
+        member enters the position filter if the probability is above the configured threshold and
+        enough members were successful (or None), or (None, None) if the ensemble failed.
+
+        ensemble is a dictionary containing:
+         - members: The number of ensemble members requested.
+         - successful: The number of successful ensemble members.
+         - entered: The number of successful ensemble members entering the position filter.
+         - probability: The fraction of requested members entering the position filter.
+           (Failed members count as not entering, so they cannot inflate the probability.)
+         - success_fraction: The fraction of requested members which were successful.
+         - entry_window: The (earliest, latest) times of entering the position filter, or None.
+         - predictions: A list of (member, prediction, entry_time) tuples.
+         - summary: A text summary of the above.
+        """
+
+        from dateutil.parser import parse
+
+        config = self.config
+
+        _members = len(config['ensemble_altitude_offsets']) * len(config['ensemble_time_offsets']) * config['ensemble_datasets']
+
+        if not self.tawhiri_governor.would_allow(callsign, cost=_members):
+            logging.debug(f"Payload {callsign} - Ensemble float prediction deferred by Tawhiri request governor.")
+            return (None, None)
+
+        logging.info(f"Payload {callsign} - Running ensemble float prediction with {_members} members.")
+
+        _ensemble = get_tawhiri_float_ensemble(
+            launch_datetime=self.telemetry_store[callsign]['last_datetime'],
+            launch_latitude=data['lat'],
+            launch_longitude=data['lon'],
+            launch_altitude=data['alt'],
+            float_time_hrs=config['float_duration'],
+            altitude_offsets=config['ensemble_altitude_offsets'],
+            time_offsets=config['ensemble_time_offsets'],
+            dataset_count=config['ensemble_datasets'],
+            max_workers=config['ensemble_workers'],
+            key=callsign,
+            governor=self.tawhiri_governor
+        )
+
+        if _ensemble is None:
+            return (None, None)
+
+        _predictions = [
+            (_member, _pred, self.prediction_filter_entry(_pred['path']))
+            for _member, _pred in _ensemble
+        ]
+
+        _entries = [_entry for (_member, _pred, _entry) in _predictions if _entry]
+
+        if _entries:
+            _entry_window = (min(_entries, key=parse), max(_entries, key=parse))
+        else:
+            _entry_window = None
+
+        _probability = len(_entries) / _members
+        _success_fraction = len(_predictions) / _members
+
+        _summary = f"Ensemble: {len(_entries)} of {_members} predictions ({_probability*100:.0f}%) enter position filter"
+        if _entry_window:
+            _summary += f", between {_entry_window[0]} and {_entry_window[1]}"
+        _summary += f" ({len(_predictions)} of {_members} predictions successful)"
+
+        logging.info(f"Payload {callsign} - {_summary}")
+
+        _output = {
+            'members': _members,
+            'successful': len(_predictions),
+            'entered': len(_entries),
+            'probability': _probability,
+            'success_fraction': _success_fraction,
+            'entry_window': _entry_window,
+            'predictions': _predictions,
+            'summary': _summary,
+        }
+
+        if _success_fraction < config['ensemble_min_success']:
+            logging.info(f"Payload {callsign} - Too few successful ensemble predictions to alert.")
+            return (_output, None)
+
+        if _entries and _probability >= config['ensemble_threshold']:
+            return (_output, _entry_window[0])
+        else:
+            return (_output, None)
+
+    def coalesce_telemetry(self, packets):
+        """
+        Coalesce a list of telemetry packets, keeping only the newest packet for each payload.
+
+        Returns a list of (packet, skipped) tuples, one per payload, where skipped is the list of older
+        packets for that payload in the order they were received. Packets are considered newer based on
+        their datetime field, or the order they were received if this cannot be compared.
+        """
+
+        from dateutil.parser import parse
+
+        _latest = {}
+
+        for _packet in packets:
+            _callsign = _packet.get('payload_callsign', None)
+
+            if _callsign not in _latest:
+                _latest[_callsign] = (_packet, [])
+                continue
+
+            _current, _skipped = _latest[_callsign]
+
+            try:
+                _newer = parse(_packet['datetime']) >= parse(_current['datetime'])
+            except Exception:
+                _newer = True
+
+            if _newer:
+                _skipped.append(_current)
+                _latest[_callsign] = (_packet, _skipped)
+            else:
+                _skipped.append(_packet)
+
+        return list(_latest.values())
+
+    def handle_telemetry_queue(self):
+        """ Telemetry queue handling """
+
+        logging.info("Telemetry Processing Thread Started.")
+        while self.telemetry_processing_running:
+            try:
+                data = self.telemetry_queue.get(timeout=0.5)
+            except Empty:
+                continue
+
+            # Collect any other packets waiting in the queue.
+            _packets = [data]
+            while True:
+                try:
+                    _packets.append(self.telemetry_queue.get_nowait())
+                except Empty:
+                    break
+
+            if self.config['coalesce_telemetry'] and len(_packets) > 1:
+                _batch = self.coalesce_telemetry(_packets)
+
+                _skipped = len(_packets) - len(_batch)
+                if _skipped > 0:
+                    self.coalesced_packets += _skipped
+                    logging.info(f"Telemetry queue backlog - processing latest of {len(_packets)} packets from {len(_batch)} payloads.")
+            else:
+                _batch = [(_packet, []) for _packet in _packets]
+
+            for (_packet, _skipped) in _batch:
+                try:
+                    with self.update_lock:
+                        self.process_telemetry(_packet, skipped=_skipped)
+                except Exception as e:
+                    logging.error(f"Error processing telemetry - {str(e)}")
+
+        logging.info("Telemetry Processing Thread Stopped.")
@@ -1,17 +1,34 @@
+import hashlib
 import logging
-from shapely.geometry import Polygon, Point
-from math import radians, degrees, sin, cos, atan2, sqrt, pi
+import os
+import pickle
+from math import radians, degrees, sin, cos, asin, atan2, sqrt, pi, floor
 
+# Earth:
+# EARTH_RADIUS = 6371000.0
+EARTH_RADIUS = 6364963.0  # Optimized for Australia :-)
 
-def create_geofence(filename):
+# Grid cell states, as stored in the grid lookup index.
+GRID_OUTSIDE = 0
+GRID_INSIDE = 1
+GRID_BOUNDARY = 2
+
+
+def create_geofence(filename, grid_cell_size=None, grid_depth=6, grid_cache_file=None):
     """
     Attempt to load in a geofence file and create a Polygon.
 
     Returns a function point which accepts a latitude and longitude, and returns True/False depending on whether
     the supplied lat/lon is within the geofence area.
 
+    If grid_cell_size (degrees) is provided, the geofence is rasterised into a grid lookup index
+    (refer create_grid_filter), and only positions near the geofence boundary are checked against the polygon.
+
     """
 
+    from shapely.geometry import Polygon, Point, box
+    from shapely.prepared import prep
+
     _f = open(filename, 'r')
 
     coords = []
@@ -32,6 +49,8 @@ def create_geofence(filename):
 
         except Exception as e:
             logging.error(f"Geofence - error parsing line in file: {line}")
+
+    _f.close()
     
     logging.debug(f"Geofence - Coordinates: {str(coords)}")
 
@@ -43,8 +62,31 @@ def create_geofence(filename):
         _point = Point(lat, lon)
 
         return _polygon.contains(_point)
-    
-    return within_bounds
+
+    if grid_cell_size is None:
+        return within_bounds
+
+    _prepared = prep(_polygon)
+
+    def classify_cell(lat_min, lon_min, lat_max, lon_max):
+        _cell = box(lat_min, lon_min, lat_max, lon_max)
+
+        if _prepared.contains(_cell):
+            return GRID_INSIDE
+        elif not _prepared.intersects(_cell):
+            return GRID_OUTSIDE
+        else:
+            return GRID_BOUNDARY
+
+    return create_grid_filter(
+        within_bounds,
+        classify_cell,
+        _polygon.bounds,
+        grid_cell_size,
+        grid_depth,
+        cache_file=grid_cache_file,
+        cache_key=("geofence", tuple(coords)),
+    )
 
 
 def position_info(listener, balloon):
@@ -65,9 +107,7 @@ def position_info(listener, balloon):
     in degrees, and input altitudes and output distances are in meters.
     """
 
-    # Earth:
-    # radius = 6371000.0
-    radius = 6364963.0  # Optimized for Australia :-)
+    radius = EARTH_RADIUS
 
     (lat1, lon1, alt1) = listener
     (lat2, lon2, alt2) = balloon
@@ -132,12 +172,82 @@ def position_info(listener, balloon):
     }
 
 
-def create_radius_filter(centre_lat, centre_lon, radius_km):
+def position_info_batch(listener, balloon):
+    """
+    Vectorised version of position_info, operating on arrays of positions.
+
+    listener and balloon are array-likes of (lat, lon, alt) positions, with shape (..., 3).
+    The two arrays are broadcast against each other, so a single listener can be compared
+    against many balloon positions, or (using listener[:, None, :] and balloon[None, :, :])
+    many listeners against many balloons.
+
+    Returns a dict of arrays (of the broadcast shape, without the last axis) with:
+
+     - angle at centre
+     - great circle distance
+     - distance in a straight line
+     - bearing (azimuth or initial course)
+     - elevation (altitude)
+
+    Units are as per position_info.
+    """
+
+    import numpy as np
+
+    radius = EARTH_RADIUS
+
+    listener = np.asarray(listener, dtype=float)
+    balloon = np.asarray(balloon, dtype=float)
+
+    lat1 = np.radians(listener[..., 0])
+    lon1 = np.radians(listener[..., 1])
+    alt1 = listener[..., 2]
+    lat2 = np.radians(balloon[..., 0])
+    lon2 = np.radians(balloon[..., 1])
+    alt2 = balloon[..., 2]
+
+    # Refer position_info for the derivation of the following.
+    d_lon = lon2 - lon1
+    sa = np.cos(lat2) * np.sin(d_lon)
+    sb = (np.cos(lat1) * np.sin(lat2)) - (np.sin(lat1) * np.cos(lat2) * np.cos(d_lon))
+    bearing = np.arctan2(sa, sb)
+    aa = np.sqrt((sa ** 2) + (sb ** 2))
+    ab = (np.sin(lat1) * np.sin(lat2)) + (np.cos(lat1) * np.cos(lat2) * np.cos(d_lon))
+    angle_at_centre = np.arctan2(aa, ab)
+    great_circle_distance = angle_at_centre * radius
+
+    ta = radius + alt1
+    tb = radius + alt2
+    ea = (np.cos(angle_at_centre) * tb) - ta
+    eb = np.sin(angle_at_centre) * tb
+    elevation = np.arctan2(ea, eb)
+
+    distance = np.sqrt((ta ** 2) + (tb ** 2) - 2 * tb * ta * np.cos(angle_at_centre))
+
+    # Give a bearing in range 0 <= b < 2pi
+    bearing = np.where(bearing < 0, bearing + 2 * pi, bearing)
+
+    return {
+        "angle_at_centre": np.degrees(angle_at_centre),
+        "angle_at_centre_radians": angle_at_centre,
+        "bearing": np.degrees(bearing),
+        "bearing_radians": bearing,
+        "great_circle_distance": great_circle_distance,
+        "straight_distance": distance,
+        "elevation": np.degrees(elevation),
+        "elevation_radians": elevation,
+    }
+
+
+def create_radius_filter(centre_lat, centre_lon, radius_km, grid_cell_size=None, grid_depth=6, grid_cache_file=None):
     """
     Create a radius-based position filter.
 
     Returns a function which accepts lat,lon and returns True/False
     if the supplied position is within the radius.
+
+    If grid_cell_size (degrees) is provided, the radius is rasterised into a grid lookup index
+    (refer create_grid_filter), and only positions near the edge of the radius are checked exactly.
     """
 
     def within_bounds(lat, lon):
@@ -152,15 +262,232 @@ def create_radius_filter(centre_lat, centre_lon, radius_km):
         else:
             return False
 
+    if grid_cell_size is None:
+        return within_bounds
+
+    def cell_distance(lat, lon, cell_lat, cell_lon):
+        return position_info((lat, lon, 0), (cell_lat, cell_lon, 0))['great_circle_distance']
+
+    def classify_cell(lat_min, lon_min, lat_max, lon_max):
+        _lat = (lat_min + lat_max) / 2
+        _lon = (lon_min + lon_max) / 2
+
+        # Distance from the cell centre to the furthest corner / edge midpoint, padded so that
+        # a cell is only marked inside/outside when every point within it is.
+        _extent = max(
+            cell_distance(_lat, _lon, _cell_lat, _cell_lon)
+            for _cell_lat in (lat_min, _lat, lat_max)
+            for _cell_lon in (lon_min, _lon, lon_max)
+        ) * 1.01
+
+        _range = cell_distance(centre_lat, centre_lon, _lat, _lon)
+
+        if _range + _extent < radius_km*1000:
+            return GRID_INSIDE
+        elif _range - _extent > radius_km*1000:
+            return GRID_OUTSIDE
+        else:
+            return GRID_BOUNDARY
+
+    # Bounding box of the radius. Longitudes are left un-wrapped (they may extend past +/-180),
+    # the grid filter normalises looked-up longitudes into this range.
+    _angle = min(radius_km*1000 / EARTH_RADIUS, pi) * 1.01
+    _lat_min = max(centre_lat - degrees(_angle), -90.0)
+    _lat_max = min(centre_lat + degrees(_angle), 90.0)
+
+    if _lat_min <= -90.0 or _lat_max >= 90.0 or _angle >= pi/2:
+        # Radius covers a pole, so covers all longitudes.
+        _lon_extent = 180.0
+    else:
+        _lon_extent = min(degrees(asin(min(sin(_angle) / cos(radians(centre_lat)), 1.0))) * 1.01, 180.0)
+
+    _bounds = (_lat_min, centre_lon - _lon_extent, _lat_max, centre_lon + _lon_extent)
+
+    return create_grid_filter(
+        within_bounds,
+        classify_cell,
+        _bounds,
+        grid_cell_size,
+        grid_depth,
+        cache_file=grid_cache_file,
+        cache_key=("radius", centre_lat, centre_lon, radius_km),
+    )
+
+
+def create_grid_filter(exact_filter, classify_cell, bounds, cell_size=1.0, depth=6, cache_file=None, cache_key=None):
+    """
+    Rasterise a position filter into a hierarchical lat/lon grid lookup index.
+
+    exact_filter: The exact position filter function, accepting lat, lon and returning True/False.
+    classify_cell: A function accepting (lat_min, lon_min, lat_max, lon_max), which returns
+        GRID_INSIDE if every point in the cell is within the filter, GRID_OUTSIDE if no point in the cell
+        is within the filter, and GRID_BOUNDARY otherwise.
+    bounds: (lat_min, lon_min, lat_max, lon_max) bounding box of the filter area.
+    cell_size: Size of the top-level grid cells, in degrees.
+    depth: Number of times boundary cells are subdivided (each subdivision halves the cell size).
+    cache_file: Optional file used to cache the index between runs.
+    cache_key: Description of the filter geometry, used to validate the cache file.
+
+    Returns a function which accepts lat, lon and returns True/False. Positions within inside/outside cells
+    are answered from the index, and only positions within boundary cells at the finest level fall through
+    to exact_filter.
+    """
+
+    _lat_min, _lon_min, _lat_max, _lon_max = bounds
+
+    _key = hashlib.sha256(repr((cache_key, tuple(bounds), cell_size, depth)).encode()).hexdigest()
+
+    levels = None
+
+    if cache_file and os.path.exists(cache_file):
+        try:
+            with open(cache_file, 'rb') as _f:
+                _cache = pickle.load(_f)
+
+            if _cache['key'] == _key:
+                levels = _cache['levels']
+                logging.info(f"Grid Filter - Loaded grid index from {cache_file}")
+            else:
+                logging.info(f"Grid Filter - Cache file {cache_file} does not match filter, rebuilding.")
+        except Exception as e:
+            logging.error(f"Grid Filter - Could not read cache file {cache_file} - {str(e)}")
+
+    if levels is None:
+        levels = []
+
+        # Cells are indexed from (-90, -180), so an index at one level can be derived from the level above.
+        _cells = [
+            (_i, _j)
+            for _i in range(floor((_lat_min + 90.0) / cell_size), floor((_lat_max + 90.0) / cell_size) + 1)
+            for _j in range(floor((_lon_min + 180.0) / cell_size), floor((_lon_max + 180.0) / cell_size) + 1)
+        ]
+
+        for _level in range(depth + 1):
+            _size = cell_size / (2 ** _level)
+            _index = {}
+            _boundary = []
+
+            for (_i, _j) in _cells:
+                _state = classify_cell(
+                    _i * _size - 90.0,
+                    _j * _size - 180.0,
+                    (_i + 1) * _size - 90.0,
+                    (_j + 1) * _size - 180.0,
+                )
+                _index[(_i, _j)] = _state
+
+                if _state == GRID_BOUNDARY:
+                    _boundary.append((_i, _j))
+
+            levels.append(_index)
+
+            # Subdivide boundary cells for the next level.
+            _cells = [
+                (2 * _i + _di, 2 * _j + _dj)
+                for (_i, _j) in _boundary
+                for _di in (0, 1)
+                for _dj in (0, 1)
+            ]
+
+        logging.info(f"Grid Filter - Built grid index with {sum(len(_l) for _l in levels)} cells, {len(_boundary)} boundary cells at finest level.")
+
+        if cache_file:
+            try:
+                with open(cache_file, 'wb') as _f:
+                    pickle.dump({'key': _key, 'levels': levels}, _f)
+                logging.info(f"Grid Filter - Saved grid index to {cache_file}")
+            except Exception as e:
+                logging.error(f"Grid Filter - Could not write cache file {cache_file} - {str(e)}")
+
+    _sizes = [cell_size / (2 ** _level) for _level in range(len(levels))]
+
+    def within_bounds(lat, lon):
+        # Normalise longitude into the range covered by the index.
+        while lon < _lon_min:
+            lon += 360.0
+        while lon >= _lon_min + 360.0:
+            lon -= 360.0
+
+        _lat = lat + 90.0
+        _lon = lon + 180.0
+
+        for _index, _size in zip(levels, _sizes):
+            _state = _index.get((floor(_lat / _size), floor(_lon / _size)), None)
+
+            if _state == GRID_INSIDE:
+                return True
+            elif _state == GRID_OUTSIDE:
+                return False
+            elif _state is None:
+                # Not in the top level means outside the bounds of the filter.
+                # (Missing at a lower level can only occur through rounding, so check exactly.)
+                if _index is levels[0]:
+                    return False
+                break
+
+        return exact_filter(lat, lon)
+
     return within_bounds
 
 
+def create_position_filter(config):
+    """
+    Create a position filter function based on the supplied configuration dictionary.
+    """
+
+    if config['grid_lookup']:
+        _grid_args = {
+            'grid_cell_size': config['grid_cell_size'],
+            'grid_depth': config['grid_depth'],
+            'grid_cache_file': config['grid_cache_file'],
+        }
+    else:
+        _grid_args = {}
+
+    if config['position_filter_type'] == 'radius':
+        position_filter = create_radius_filter(config['radius_latitude'], config['radius_longitude'], config['radius'], **_grid_args)
+        logging.info(f"Created radius filter with centre {config['radius_latitude']},{config['radius_longitude']}, and radius {config['radius']} km.")
+    else:
+        position_filter = create_geofence(config['geofence_file'], **_grid_args)
+        logging.info(f"Created geofence filter from file {config['geofence_file']}")
+
+    if config['grid_lookup']:
+        logging.info(f"Using grid lookup with {config['grid_cell_size']} degree cells, depth {config['grid_depth']}.")
+
+    return position_filter
+
+
+def position_filter_signature(config):
+    """
+    Return a value describing the position filter settings within a configuration dictionary.
+    If the signature of two configurations differ, the position filter needs to be re-created.
+    """
+
+    _signature = [config['position_filter_type'], config['grid_lookup']]
+
+    if config['grid_lookup']:
+        _signature += [config['grid_cell_size'], config['grid_depth'], config['grid_cache_file']]
+
+    if config['position_filter_type'] == 'radius':
+        _signature += [config['radius_latitude'], config['radius_longitude'], config['radius']]
+    else:
+        # Include the modification time of the geofence file, so edits to the file are picked up.
+        try:
+            _stat = os.stat(config['geofence_file'])
+            _signature += [config['geofence_file'], _stat.st_mtime, _stat.st_size]
+        except OSError:
+            _signature += [config['geofence_file'], None, None]
+
+    return tuple(_signature)
+
+
 
 
 
 if __name__ == "__main__":
 
     import sys
+    import numpy as np
 
     logging.basicConfig(
         format="%(asctime)s %(levelname)s:%(message)s",
@@ -168,13 +495,40 @@ if __name__ == "__main__":
         level=logging.DEBUG,
     )
 
-    _filename = sys.argv[1]
+    # Check the batch position calculations against the scalar version.
+    listeners = np.array([[-34.0, 138.0, 0.0], [51.5, -0.1, 100.0], [0.0, 179.9, 0.0]])
+    balloons = np.array([[-34.1, 138.1, 10000.0], [40.0, 138.0, 15000.0], [0.0, -179.9, 12000.0], [52.7795, -167.62716666666665, 14000.0]])
 
-    position_filter = create_geofence(_filename)
+    # Many-to-many
+    batch_info = position_info_batch(listeners[:, None, :], balloons[None, :, :])
 
-    test_coords = [ [-34.0, 138.0], [0.0, 0.0], [40, 138.0], [52.7795, -167.62716666666665] ]
-    for coord in test_coords:
-        print(f"Coord {coord[0]}, {coord[1]} within geofence: {position_filter(coord[0], coord[1])}")
+    for i, listener in enumerate(listeners):
+        for j, balloon in enumerate(balloons):
+            scalar_info = position_info(tuple(listener), tuple(balloon))
+            for key in batch_info:
+                assert abs(scalar_info[key] - batch_info[key][i, j]) < 1e-6, f"Batch mismatch in {key}"
+
+    # One-to-many
+    for listener in listeners:
+        batch_info = position_info_batch(listener, balloons)
+        assert batch_info['great_circle_distance'].shape == (len(balloons),), "Batch one-to-many shape mismatch"
+
+        for j, balloon in enumerate(balloons):
+            scalar_info = position_info(tuple(listener), tuple(balloon))
+            for key in batch_info:
+                assert abs(scalar_info[key] - batch_info[key][j]) < 1e-6, f"Batch one-to-many mismatch in {key}"
+
+    print(f"Batch position info consistent with scalar version for {len(listeners) * len(balloons)} pairs (many-to-many and one-to-many).")
+
+    # Geofence demo, if a geofence file is supplied.
+    if len(sys.argv) > 1:
+        _filename = sys.argv[1]
+
+        position_filter = create_geofence(_filename)
+
+        test_coords = [ [-34.0, 138.0], [0.0, 0.0], [40, 138.0], [52.7795, -167.62716666666665] ]
+        for coord in test_coords:
+            print(f"Coord {coord[0]}, {coord[1]} within geofence: {position_filter(coord[0], coord[1])}")
 
     
     radius_filter = create_radius_filter(-34.0, 138.0, 1000.0)
@@ -183,3 +537,8 @@ if __name__ == "__main__":
     test_coords = [ [-34.0, 138.0], [-34.1, 138.1], [0.0, 0.0], [40, 138.0] ]
     for coord in test_coords:
         print(f"Coord {coord[0]}, {coord[1]} within radius: {radius_filter(coord[0], coord[1])}")
+
+    grid_filter = create_radius_filter(-34.0, 138.0, 1000.0, grid_cell_size=1.0)
+
+    for coord in test_coords:
+        print(f"Coord {coord[0]}, {coord[1]} within radius (grid lookup): {grid_filter(coord[0], coord[1])}")
@@ -10,15 +10,348 @@
 #
 import datetime
 import logging
-import pytz
-import requests
+import random
 import subprocess
-from dateutil.parser import parse
-from threading import Thread
+import time
+from threading import Lock, Thread
 
 TAWHIRI_API_URL = "http://api.v2.sondehub.org/tawhiri"
 
 
+class TawhiriGovernor(object):
+    """
+    Governs requests made to the Tawhiri API, so that an outage or slow API does not
+    result in a flood of doomed requests.
+
+    Provides:
+     - A token-bucket rate limit, shared across all requests.
+     - Jittered exponential backoff per key (e.g. payload callsign), after failed requests.
+     - A circuit breaker, which stops all requests for a cooldown period after repeated
+       consecutive failures. After the cooldown a single trial request is allowed through,
+       which either closes the circuit (on success) or re-opens it (on failure).
+
+    The governor state can be obtained with get_status().
+    """
+
+    def __init__(
+        self,
+        rate=0.5,
+        burst=10,
+        backoff_base=60.0,
+        backoff_max=3600.0,
+        failure_threshold=5,
+        cooldown=600.0,
+    ):
+        """
+        rate: Token-bucket refill rate, in requests per second.
+        burst: Token-bucket capacity, i.e. the number of requests which can be made at once.
+        backoff_base: Backoff time after the first failure for a key, in seconds.
+        backoff_max: Maximum backoff time for a key, in seconds.
+        failure_threshold: Number of consecutive failures after which the circuit is opened.
+        cooldown: Time the circuit stays open before a trial request is allowed, in seconds.
+        """
+
+        self.rate = rate
+        self.burst = burst
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+
+        self.lock = Lock()
+
+        self.tokens = float(burst)
+        self.last_refill = time.monotonic()
+
+        # Circuit breaker state - one of 'closed', 'open' or 'half-open'
+        self.circuit_state = "closed"
+        self.consecutive_failures = 0
+        self.circuit_opened = 0
+        self.trial_in_progress = False
+
+        # Per-key backoff state, as {key: {'failures': n, 'retry_time': t}}
+        self.backoff = {}
+
+        # Statistics
+        self.stats = {
+            "requests": 0,
+            "successes": 0,
+            "failures": 0,
+            "rate_limited": 0,
+            "backed_off": 0,
+            "circuit_rejected": 0,
+        }
+
+    def set_limits(
+        self,
+        rate=None,
+        burst=None,
+        backoff_base=None,
+        backoff_max=None,
+        failure_threshold=None,
+        cooldown=None,
+    ):
+        """
+        Update the governor limits, retaining the current rate-limit, backoff and circuit breaker state.
+        Limits which are not supplied are left unchanged.
+        """
+
+        with self.lock:
+            if rate is not None:
+                self.rate = rate
+            if burst is not None:
+                self.burst = burst
+                self.tokens = min(self.tokens, float(burst))
+            if backoff_base is not None:
+                self.backoff_base = backoff_base
+            if backoff_max is not None:
+                self.backoff_max = backoff_max
+            if failure_threshold is not None:
+                self.failure_threshold = failure_threshold
+            if cooldown is not None:
+                self.cooldown = cooldown
+
+    def allow_request(self, key=None, cost=1):
+        """
+        Check if a request should be made now, consuming a rate-limit token if so.
+        Returns True if the request can proceed, and False otherwise.
+
+        A batch of requests (e.g. an ensemble prediction) can be allowed at once by setting cost to
+        the number of requests. Batches larger than the bucket capacity are never allowed.
+        """
+
+        with self.lock:
+            _now = time.monotonic()
+
+            if self.circuit_state == "open":
+                if (_now - self.circuit_opened) < self.cooldown:
+                    self.stats["circuit_rejected"] += 1
+                    return False
+
+                self.circuit_state = "half-open"
+                logging.info("Tawhiri - Circuit breaker cooldown expired, allowing trial request.")
+
+            if self.circuit_state == "half-open" and self.trial_in_progress:
+                self.stats["circuit_rejected"] += 1
+                return False
+
+            if key in self.backoff and _now < self.backoff[key]["retry_time"]:
+                self.stats["backed_off"] += 1
+                return False
+
+            # Refill the token bucket
+            self.tokens = min(self.burst, self.tokens + (_now - self.last_refill) * self.rate)
+            self.last_refill = _now
+
+            if self.tokens < cost:
+                self.stats["rate_limited"] += 1
+                return False
+
+            self.tokens -= cost
+
+            if self.circuit_state == "half-open":
+                self.trial_in_progress = True
+
+            self.stats["requests"] += cost
+            return True
+
+    def would_allow(self, key=None, cost=1):
+        """
+        Check if a request would be allowed by allow_request, without consuming a rate-limit token
+        or changing the governor state.
+        """
+
+        with self.lock:
+            _now = time.monotonic()
+
+            if self.circuit_state == "open" and (_now - self.circuit_opened) < self.cooldown:
+                return False
+
+            if self.circuit_state == "half-open" and self.trial_in_progress:
+                return False
+
+            if key in self.backoff and _now < self.backoff[key]["retry_time"]:
+                return False
+
+            _tokens = min(self.burst, self.tokens + (_now - self.last_refill) * self.rate)
+
+            return _tokens >= cost
+
+    def record_success(self, key=None, count=1, failed=0):
+        """
+        Record a successful request.
+
+        For a batch of requests, count is the number of successful requests, and failed is the
+        number of requests which failed. The batch counts once towards the backoff and circuit breaker.
+        """
+
+        with self.lock:
+            self.stats["successes"] += count
+            self.stats["failures"] += failed
+            self.consecutive_failures = 0
+            self.trial_in_progress = False
+            self.backoff.pop(key, None)
+
+            if self.circuit_state != "closed":
+                self.circuit_state = "closed"
+                logging.info("Tawhiri - Circuit breaker closed, predictions resumed.")
+
+    def record_failure(self, key=None, endpoint_failure=True, count=1):
+        """
+        Record a failed request, or count failed requests from a batch.
+
+        endpoint_failure should be set to False if the API responded correctly, but could not
+        provide a prediction (e.g. the request was outside the dataset bounds). These failures only
+        cause the key to back off, and do not count towards opening the circuit breaker.
+        """
+
+        with self.lock:
+            _now = time.monotonic()
+
+            self.stats["failures"] += count
+
+            # Per-key jittered exponential backoff.
+            _failures = self.backoff.get(key, {"failures": 0})["failures"] + 1
+            _delay = min(self.backoff_base * (2 ** (_failures - 1)), self.backoff_max)
+            _delay = _delay / 2 + random.uniform(0, _delay / 2)
+            self.backoff[key] = {"failures": _failures, "retry_time": _now + _delay}
+
+            logging.debug(f"Tawhiri - Backing off {key} for {_delay:.0f} seconds after {_failures} failures.")
+
+            if not endpoint_failure:
+                self.trial_in_progress = False
+                return
+
+            self.consecutive_failures += 1
+
+            if self.circuit_state == "half-open" or (
+                self.circuit_state == "closed" and self.consecutive_failures >= self.failure_threshold
+            ):
+                self.circuit_state = "open"
+                self.circuit_opened = _now
+                self.trial_in_progress = False
+                logging.warning(
+                    f"Tawhiri - Circuit breaker opened after {self.consecutive_failures} consecutive failures, "
+                    f"predictions suspended for {self.cooldown:.0f} seconds."
+                )
+
+    def get_status(self):
+        """
+        Return the current governor state as a dictionary.
+        'degraded' is True if predictions are currently suspended or being trialled.
+        """
+
+        with self.lock:
+            _now = time.monotonic()
+
+            if self.circuit_state == "open":
+                _cooldown_remaining = max(0.0, self.cooldown - (_now - self.circuit_opened))
+            else:
+                _cooldown_remaining = 0.0
+
+            return {
+                "circuit_state": self.circuit_state,
+                "degraded": self.circuit_state != "closed",
+                "consecutive_failures": self.consecutive_failures,
+                "cooldown_remaining": _cooldown_remaining,
+                "tokens": min(self.burst, self.tokens + (_now - self.last_refill) * self.rate),
+                "backed_off": {
+                    _key: _state["retry_time"] - _now
+                    for _key, _state in self.backoff.items()
+                    if _state["retry_time"] > _now
+                },
+                "stats": dict(self.stats),
+            }
+
+
+# Governor shared by all Tawhiri requests, unless another is supplied.
+tawhiri_governor = TawhiriGovernor()
+
+# Pooled HTTP session, created on first use.
+TAWHIRI_POOL_SIZE = 16
+tawhiri_session = None
+tawhiri_session_lock = Lock()
+
+
+def get_tawhiri_session():
+    """
+    Return the HTTP session used for all Tawhiri requests, so connections are pooled
+    between requests (including the concurrent requests made by ensemble predictions).
+    """
+
+    global tawhiri_session
+
+    with tawhiri_session_lock:
+        if tawhiri_session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            tawhiri_session = requests.Session()
+            _adapter = HTTPAdapter(pool_connections=1, pool_maxsize=TAWHIRI_POOL_SIZE)
+            tawhiri_session.mount("http://", _adapter)
+            tawhiri_session.mount("https://", _adapter)
+
+        return tawhiri_session
+
+
+def fetch_tawhiri_prediction(params, timeout=10):
+    """
+    Request a prediction from the Tawhiri API using the supplied parameters, without consulting
+    a request governor.
+
+    Returns a tuple of (prediction, endpoint_failure). prediction is the parsed prediction, or None
+    on failure, in which case endpoint_failure indicates if the failure was due to the API itself
+    (e.g. a timeout or server error) rather than the request.
+    """
+
+    try:
+        _r = get_tawhiri_session().get(TAWHIRI_API_URL, params=params, timeout=timeout)
+
+        _json = _r.json()
+
+        if "error" in _json:
+            # The Tawhiri API has returned an error
+            _error = "%s: %s" % (_json["error"]["type"], _json["error"]["description"])
+
+            logging.error("Tawhiri - %s" % _error)
+
+            # Server-side errors indicate a problem with the API, rather than with this request.
+            return (None, _r.status_code >= 500)
+
+        else:
+            return (parse_tawhiri_data(_json), False)
+
+    except Exception as e:
+        logging.error("Tawhiri - Error running prediction: %s" % str(e))
+
+        return (None, True)
+
+
+def request_tawhiri_prediction(params, timeout=10, key=None, governor=None):
+    """
+    Request a prediction from the Tawhiri API using the supplied parameters,
+    subject to the supplied (or shared) request governor.
+
+    Returns the parsed prediction, or None if the request was not made or failed.
+    """
+
+    if governor is None:
+        governor = tawhiri_governor
+
+    if not governor.allow_request(key):
+        logging.debug(f"Tawhiri - Prediction request for {key} deferred by request governor.")
+        return None
+
+    _output, _endpoint_failure = fetch_tawhiri_prediction(params, timeout=timeout)
+
+    if _output is None:
+        governor.record_failure(key, endpoint_failure=_endpoint_failure)
+    else:
+        governor.record_success(key)
+
+    return _output
+
+
 def get_tawhiri_prediction(
     launch_datetime,
     launch_latitude,
@@ -30,9 +363,13 @@ def get_tawhiri_prediction(
     profile="standard_profile",
     dataset=None,
     timeout=10,
+    key=None,
+    governor=None,
 ):
     """ Request a Prediction from the Tawhiri Predictor API """
 
+    import pytz
+
     # Localise supplied time to UTC if not already done
     if launch_datetime.tzinfo is None:
         launch_datetime = pytz.utc.localize(launch_datetime)
@@ -60,29 +397,137 @@ def get_tawhiri_prediction(
 
     logging.debug("Tawhiri - Requesting prediction using parameters: %s" % str(_params))
 
-    try:
-        _r = requests.get(TAWHIRI_API_URL, params=_params, timeout=timeout)
+    return request_tawhiri_prediction(_params, timeout=timeout, key=key, governor=governor)
 
-        _json = _r.json()
 
-        if "error" in _json:
-            # The Tawhiri API has returned an error
-            _error = "%s: %s" % (_json["error"]["type"], _json["error"]["description"])
+def get_tawhiri_float_prediction(
+    launch_datetime,
+    launch_latitude,
+    launch_longitude,
+    launch_altitude=15000.0,
+    ascent_rate=5.0,
+    float_altitude=None,
+    profile="float_profile",
+    float_time_hrs = 48,
+    dataset=None,
+    timeout=10,
+    key=None,
+    governor=None,
+):
+    """ Request a Float Prediction from the Tawhiri Predictor API """
 
-            logging.error("Tawhiri - %s" % _error)
+    _params = float_prediction_params(
+        launch_datetime,
+        launch_latitude,
+        launch_longitude,
+        launch_altitude=launch_altitude,
+        ascent_rate=ascent_rate,
+        float_altitude=float_altitude,
+        profile=profile,
+        float_time_hrs=float_time_hrs,
+        dataset=dataset,
+    )
 
-            return None
+    logging.debug("Tawhiri - Requesting float prediction using parameters: %s" % str(_params))
 
-        else:
-            return parse_tawhiri_data(_json)
+    return request_tawhiri_prediction(_params, timeout=timeout, key=key, governor=governor)
 
-    except Exception as e:
-        logging.error("Tawhiri - Error running prediction: %s" % str(e))
 
+def get_tawhiri_float_ensemble(
+    launch_datetime,
+    launch_latitude,
+    launch_longitude,
+    launch_altitude=15000.0,
+    float_time_hrs=48,
+    altitude_offsets=(0.0,),
+    time_offsets=(0.0,),
+    dataset_count=1,
+    max_workers=8,
+    timeout=10,
+    key=None,
+    governor=None,
+):
+    """
+    Request an ensemble of Float Predictions from the Tawhiri Predictor API.
+
+    One prediction is run for every combination of:
+     - altitude_offsets: Offsets applied to the float altitude, in metres.
+     - time_offsets: Offsets applied to the prediction start time, in hours.
+     - dataset_count: Number of datasets to use - the latest dataset, and then the preceding
+       (6-hourly) datasets. Older datasets may not be available, in which case those members fail.
+
+    The predictions are requested concurrently (using up to max_workers threads), and the whole
+    ensemble is subject to a single request governor check, so it completes in about the time
+    of a single prediction.
+
+    Returns a list of (member, prediction) tuples for each successful prediction, where member is
+    a dict of the perturbations applied, or None if the ensemble was not run or no predictions succeeded.
+    """
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    if governor is None:
+        governor = tawhiri_governor
+
+    # Datasets to use. None requests the latest dataset, and older datasets are estimated
+    # from the current time, assuming the latest dataset is at least 6 hours old.
+    _datasets = [None]
+    if dataset_count > 1:
+        _latest = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=6)
+        _latest = _latest.replace(hour=_latest.hour - (_latest.hour % 6), minute=0, second=0, microsecond=0)
+        for _i in range(1, dataset_count):
+            _datasets.append((_latest - datetime.timedelta(hours=6*_i)).strftime("%Y-%m-%dT%H:%M:%SZ"))
+
+    _members = [
+        {"altitude_offset": _alt, "time_offset": _time, "dataset": _dataset}
+        for _alt in altitude_offsets
+        for _time in time_offsets
+        for _dataset in _datasets
+    ]
+
+    if len(_members) > governor.burst:
+        logging.error(
+            f"Tawhiri - Ensemble of {len(_members)} members exceeds the request burst limit of {governor.burst:.0f}, not running."
+        )
         return None
 
+    if not governor.allow_request(key, cost=len(_members)):
+        logging.debug(f"Tawhiri - Ensemble prediction request for {key} deferred by request governor.")
+        return None
 
-def get_tawhiri_float_prediction(
+    def run_member(member):
+        _params = float_prediction_params(
+            launch_datetime + datetime.timedelta(hours=member["time_offset"]),
+            launch_latitude,
+            launch_longitude,
+            launch_altitude=launch_altitude + member["altitude_offset"],
+            float_time_hrs=float_time_hrs,
+            dataset=member["dataset"],
+        )
+
+        logging.debug("Tawhiri - Requesting ensemble float prediction using parameters: %s" % str(_params))
+
+        return fetch_tawhiri_prediction(_params, timeout=timeout)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(_members)))) as _executor:
+        _results = list(_executor.map(run_member, _members))
+
+    _output = [(_member, _result[0]) for _member, _result in zip(_members, _results) if _result[0] is not None]
+
+    # Governor statistics count individual members, in the same units as the request cost.
+    if _output:
+        governor.record_success(key, count=len(_output), failed=len(_members) - len(_output))
+    else:
+        # Only count as an endpoint failure if every member failed due to the API.
+        governor.record_failure(key, endpoint_failure=all(_result[1] for _result in _results), count=len(_members))
+        return None
+
+    logging.debug(f"Tawhiri - Ensemble prediction for {key}: {len(_output)} of {len(_members)} members successful.")
+
+    return _output
+
+
+def float_prediction_params(
     launch_datetime,
     launch_latitude,
     launch_longitude,
@@ -90,10 +535,12 @@ def get_tawhiri_float_prediction(
     ascent_rate=5.0,
     float_altitude=None,
     profile="float_profile",
-    float_time_hrs = 48,
-    timeout=10,
+    float_time_hrs=48,
+    dataset=None,
 ):
-    """ Request a Float Prediction from the Tawhiri Predictor API """
+    """ Create the Tawhiri API parameters for a Float Prediction """
+
+    import pytz
 
     # Localise supplied time to UTC if not already done
     if launch_datetime.tzinfo is None:
@@ -131,33 +578,17 @@ def get_tawhiri_float_prediction(
         "profile": profile,
     }
 
+    if dataset:
+        _params["dataset"] = dataset
 
-    logging.debug("Tawhiri - Requesting float prediction using parameters: %s" % str(_params))
-
-    try:
-        _r = requests.get(TAWHIRI_API_URL, params=_params, timeout=timeout)
-
-        _json = _r.json()
-
-        if "error" in _json:
-            # The Tawhiri API has returned an error
-            _error = "%s: %s" % (_json["error"]["type"], _json["error"]["description"])
-
-            logging.error("Tawhiri - %s" % _error)
-
-            return None
-
-        else:
-            return parse_tawhiri_data(_json)
-
-    except Exception as e:
-        logging.error("Tawhiri - Error running prediction: %s" % str(e))
-
-        return None
+    return _params
 
 def parse_tawhiri_data(data):
     """ Parse a returned flight trajectory from Tawhiri, and convert it to a cusf_predictor_wrapper compatible format """
 
+    import pytz
+    from dateutil.parser import parse
+
     _epoch = pytz.utc.localize(datetime.datetime(1970, 1, 1))
     # Extract dataset information
     _dataset = parse(data["request"]["dataset"])
@@ -226,4 +657,20 @@ if __name__ == "__main__":
         launch_altitude=10000,
         float_time_hrs=24
     )
-    pprint.pprint(_data)
\ No newline at end of file
+    pprint.pprint(_data)
+
+    # Ensemble float prediction
+    _start = time.time()
+    _data = get_tawhiri_float_ensemble(
+        launch_datetime=_now,
+        launch_latitude=-34.9499,
+        launch_longitude=138.5194,
+        launch_altitude=10000,
+        float_time_hrs=24,
+        altitude_offsets=(-1000.0, 0.0, 1000.0),
+        time_offsets=(0.0, 1.0),
+    )
+    if _data:
+        for _member, _pred in _data:
+            print(f"Member {_member}: {len(_pred['path'])} points, ends at {_pred['path'][-1]}")
+    print(f"Ensemble took {time.time() - _start:.1f} seconds.")
\ No newline at end of file